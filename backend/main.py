@@ -1,43 +1,88 @@
 
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse
+from fastapi.sse import EventSourceResponse, ServerSentEvent
 from pydantic import BaseModel, field_validator
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
+import orjson
+import asyncio
+import ipaddress
+import logging
 import os
 import re
+import secrets
 import time
-import json
-from collections import defaultdict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Final
 from dotenv import load_dotenv
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from redis import asyncio as aioredis
+from limits import parse
+from limits.aio.storage import MemoryStorage, RedisStorage
+from limits.aio.strategies import FixedWindowRateLimiter
 
 load_dotenv()
 
-# Rate limiter setup
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI()
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+logger = logging.getLogger(__name__)
 
 # Security configuration
-ALLOWED_ORIGINS = [
+ALLOWED_ORIGINS: Final = (
     "http://localhost:5173",  # Local development
     "https://sugya-app-frontend.onrender.com",  # Production frontend
     "http://localhost:4173",  # Vite preview
-]
-
-# Configure CORS properly
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=ALLOWED_ORIGINS,
-    allow_credentials=True,
-    allow_methods=["GET", "POST"],
-    allow_headers=["*"],
 )
 
+MAX_CHAT_BODY_BYTES = 64_000
+
+class BodySizeLimitMiddleware:
+    """Reject oversized chat request bodies before they are read and parsed"""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/chat"):
+            await self.app(scope, receive, send)
+            return
+
+        too_large = JSONResponse(status_code=413, content={"detail": "Payload too large"})
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            if content_length.isdigit() and int(content_length) > self.max_bytes:
+                await too_large(scope, receive, send)
+                return
+            await self.app(scope, receive, send)
+            return
+
+        # Chunked body: count bytes as they arrive and answer 413 once the
+        # limit is crossed, then drop whatever the app tries to send
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request" and not rejected:
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    await too_large(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
 # Security constants - more flexible
 MAX_MESSAGE_LENGTH = 5000
 MAX_MESSAGES_PER_REQUEST = 50
@@ -50,6 +95,30 @@ SUSPICIOUS_PATTERNS = [
     r"jailbreak\s+mode",
 ]
 
+_SUSPICIOUS_RE: Final = re.compile(
+    "|".join(f"(?:{p})" for p in SUSPICIOUS_PATTERNS), re.IGNORECASE
+)
+
+def _ignorecase_variants(letters: set) -> frozenset:
+    """Return every character re.IGNORECASE matches against one of the ASCII letters"""
+    # The only non-ASCII characters that case-fold to an ASCII letter are
+    # U+0130 "İ", U+0131 "ı", U+017F "ſ" and U+212A (Kelvin sign), all below
+    # U+3000, so scanning that range finds every variant
+    pattern = re.compile(f"[{''.join(letters)}]", re.IGNORECASE)
+    return frozenset(chr(c) for c in range(0x3000) if pattern.match(chr(c)))
+
+# Every pattern starts with one of these letters; content without any of them,
+# e.g. Hebrew-only text, cannot match, so the regex scan is skipped
+_SUSPICIOUS_FIRST_CHARS: Final = _ignorecase_variants({p[0] for p in SUSPICIOUS_PATTERNS})
+
+# System prompts and chat history are resent on every turn, so scan results
+# are cached per content string
+@lru_cache(maxsize=1024)
+def _is_suspicious(content: str) -> bool:
+    if _SUSPICIOUS_FIRST_CHARS.isdisjoint(content):
+        return False
+    return _SUSPICIOUS_RE.search(content) is not None
+
 class ChatRequest(BaseModel):
     messages: list
     
@@ -59,79 +128,235 @@ class ChatRequest(BaseModel):
         if not messages or len(messages) > MAX_MESSAGES_PER_REQUEST:
             raise ValueError(f"Messages must be between 1 and {MAX_MESSAGES_PER_REQUEST}")
         
+        cleaned = []
+        previous = None
         for msg in messages:
-            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
+            if not isinstance(msg, dict) or 'role' not in msg or not isinstance(msg.get('content'), str):
                 raise ValueError("Invalid message format")
             
+            # Drop empty messages and consecutive duplicates (e.g. UI retries)
+            # so they are neither validated nor sent to OpenAI
+            key = (msg['role'], msg['content'])
+            if not msg['content'].strip() or key == previous:
+                continue
+            previous = key
+            
             if len(msg['content']) > MAX_MESSAGE_LENGTH:
                 raise ValueError(f"Message too long (max {MAX_MESSAGE_LENGTH} characters)")
             
             # Check for prompt injection attempts
-            content_lower = msg['content'].lower()
-            for pattern in SUSPICIOUS_PATTERNS:
-                if re.search(pattern, content_lower, re.IGNORECASE):
-                    raise ValueError("Message contains suspicious content")
+            if _is_suspicious(msg['content']):
+                raise ValueError("Message contains suspicious content")
+            
+            cleaned.append(msg)
+        
+        if not cleaned:
+            raise ValueError("No non-empty messages provided")
         
-        return messages
+        return cleaned
+
+# Fail at startup rather than on the first request
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+if not OPENAI_API_KEY:
+    raise RuntimeError("OpenAI API key not set")
+
+# Initialize OpenAI client. Streams hold a connection for their whole
+# duration, so keep a larger pool of warm connections and multiplex over
+# HTTP/2 to avoid a TLS handshake per request under load.
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=300),
+        timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0),
+    ),
+)
+
+# Session limits: 1000 requests per rolling hour per IP
+SESSION_LIMIT = 1000
+SESSION_WINDOW_MS = 3600 * 1000
+
+# Sliding window over a sorted set of request timestamps. Trimming, counting
+# and recording the request run as one script so concurrent requests and
+# multiple workers cannot race past the limit.
+SESSION_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window)
+return 1
+"""
+
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+session_limit_script = redis_client.register_script(SESSION_LIMIT_SCRIPT) if redis_client else None
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Rate limiter setup: 100 requests per minute per IP on each chat route,
+# counted in Redis when configured so the limit holds across workers. The
+# async storage reuses redis_client's pool so checks never block the loop.
+CHAT_RATE_LIMIT: Final = parse("100/minute")
+rate_limiter = FixedWindowRateLimiter(
+    RedisStorage(
+        f"async+{REDIS_URL}",
+        implementation="redispy",
+        connection_pool=redis_client.connection_pool,
+    )
+    if redis_client
+    else MemoryStorage()
+)
+
+# Simple in-memory store for session tracking, used when REDIS_URL is not set.
+# Keyed by (client IP, hour bucket) so a new hour starts a fresh count.
+session_store: dict[tuple[str, int], int] = {}
+SESSION_PRUNE_INTERVAL = 300  # seconds
+
+async def prune_session_store():
+    """Periodically drop counters from past hour buckets"""
+    while True:
+        await asyncio.sleep(SESSION_PRUNE_INTERVAL)
+        current_bucket = int(time.time()) // 3600
+        for key in [key for key in session_store if key[1] < current_bucket]:
+            del session_store[key]
 
-# Simple in-memory store for session tracking (use Redis in production)
-session_store = defaultdict(lambda: {"count": 0, "last_reset": time.time()})
+# Proxies whose X-Forwarded-For entries are trusted (comma-separated CIDRs).
+# Only loopback by default: trusting private ranges would let any client
+# behind e.g. a docker bridge gateway pick its own IP. Deployments behind a
+# load balancer set this to the balancer's range.
+TRUSTED_PROXIES: Final = frozenset(
+    ipaddress.ip_network(network.strip())
+    for network in os.getenv("TRUSTED_PROXIES", "127.0.0.0/8,::1/128").split(",")
+    if network.strip()
+)
+
+def _parse_ip(value: str):
+    try:
+        return ipaddress.ip_address(value)
+    except ValueError:
+        return None
+
+def _is_trusted_proxy(ip) -> bool:
+    return ip is not None and any(ip in network for network in TRUSTED_PROXIES)
 
 def get_client_ip(request: Request) -> str:
-    """Get client IP, considering proxy headers"""
+    """Get client IP, walking X-Forwarded-For right to left past trusted proxies"""
+    client_ip = request.client.host
     forwarded_for = request.headers.get("X-Forwarded-For")
-    if forwarded_for:
-        return forwarded_for.split(",")[0].strip()
-    return request.client.host
+    if not forwarded_for or not _is_trusted_proxy(_parse_ip(client_ip)):
+        return client_ip
+
+    # Only the entries appended by our own proxies can be trusted; anything
+    # to the left of the first untrusted hop may be forged by the client
+    end = len(forwarded_for)
+    while end > 0:
+        start = forwarded_for.rfind(",", 0, end) + 1
+        hop = _parse_ip(forwarded_for[start:end].strip())
+        if hop is None:
+            break
+        client_ip = str(hop)
+        if not _is_trusted_proxy(hop):
+            break
+        end = start - 1
+    return client_ip
 
-def check_session_limits(client_ip: str) -> bool:
+async def check_session_limits(client_ip: str) -> bool:
     """Check if client has exceeded session limits"""
-    current_time = time.time()
-    session = session_store[client_ip]
-    
-    # Reset counter every hour
-    if current_time - session["last_reset"] > 3600:
-        session["count"] = 0
-        session["last_reset"] = current_time
-    
-    # Limit: 1000 requests per hour per IP
-    if session["count"] >= 1000:
+    if session_limit_script is not None:
+        now_ms = int(time.time() * 1000)
+        # Unique member so requests in the same millisecond are all counted
+        member = f"{now_ms}:{secrets.token_hex(4)}"
+        allowed = await session_limit_script(
+            keys=[f"rl:{client_ip}"],
+            args=[now_ms, SESSION_WINDOW_MS, SESSION_LIMIT, member],
+        )
+        return bool(allowed)
+
+    key = (client_ip, int(time.time()) // 3600)
+    count = session_store.get(key, 0)
+    if count >= SESSION_LIMIT:
         return False
     
-    session["count"] += 1
+    session_store[key] = count + 1
     return True
 
-def filter_system_messages(messages: list) -> list:
-    """Filter and validate system messages to prevent prompt injection"""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Redis expires its own keys; the in-memory fallback needs pruning
+    prune_task = asyncio.create_task(prune_session_store()) if session_limit_script is None else None
+    yield
+    if prune_task is not None:
+        prune_task.cancel()
+    await client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+# Keywords an allowed system message must contain. Hebrew has no case, so
+# only the ASCII keywords need a lowercased copy of the content.
+_HEBREW_KEYWORDS: Final = ("חברותא דיגיטלית", "ייאוש שלא מדעת", "אביי", "רבא")
+_ASCII_KEYWORDS: Final = ("chavruta", "abaye", "rava")
+
+@lru_cache(maxsize=256)
+def _system_allowed(content: str) -> bool:
+    """Check whether a system message contains one of the expected keywords"""
+    if any(keyword in content for keyword in _HEBREW_KEYWORDS):
+        return True
+    content_lower = content.lower()
+    return any(keyword in content_lower for keyword in _ASCII_KEYWORDS)
+
+def filter_system_messages(messages: list) -> tuple[list, int]:
+    """Filter and validate system messages, returning them with their total length"""
     filtered_messages = []
-    allowed_system_content = {
-        "חברותא דיגיטלית", "ייאוש שלא מדעת", "אביי", "רבא", "chavruta", "abaye", "rava"
-    }
+    total_chars = 0
     
     for msg in messages:
         if msg.get("role") == "system":
             # Only allow system messages that contain expected keywords
-            content_lower = msg["content"].lower()
-            if any(keyword.lower() in content_lower for keyword in allowed_system_content):
-                filtered_messages.append(msg)
-            # Skip suspicious system messages
-        else:
-            filtered_messages.append(msg)
+            if not _system_allowed(msg["content"]):
+                # Skip suspicious system messages
+                continue
+        filtered_messages.append(msg)
+        total_chars += len(msg["content"])
     
-    return filtered_messages
+    return filtered_messages, total_chars
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_CHAT_BODY_BYTES)
+
+# Configure CORS properly
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["*"],
+)
 
 @app.get("/")
 async def root():
     return {"message": "Sugya App Backend API"}
 
+# Streaming: coalesce OpenAI deltas into fewer SSE events
+STREAM_FLUSH_CHARS = 48
+STREAM_FLUSH_INTERVAL = 0.025  # seconds
+
+# End-of-stream event, pre-serialized once
+_DONE_EVENT: Final = ServerSentEvent(raw_data='{"content":"","done":true}')
+
+def sse_event(payload: dict) -> ServerSentEvent:
+    """Build an SSE event whose data is serialized with orjson"""
+    return ServerSentEvent(raw_data=orjson.dumps(payload).decode())
+
 async def generate_stream(filtered_messages: list):
     """Generate streaming response from OpenAI"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
     try:
         
-        stream = client.chat.completions.create(
+        stream = await client.chat.completions.create(
             model="gpt-4o",
             messages=filtered_messages,
             max_tokens=1000,
@@ -139,84 +364,86 @@ async def generate_stream(filtered_messages: list):
             stream=True
         )
         
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                content = chunk.choices[0].delta.content
-                print(f"Streaming chunk: {content}")  # Debug log
-                yield f"data: {json.dumps({'content': content, 'done': False})}\n\n"
+        # Buffer deltas and flush by size or age; the first non-empty delta
+        # is sent immediately to keep time-to-first-token low
+        deltas = 0
+        buffer = []
+        buffered_chars = 0
+        last_flush = None
+        
+        async for chunk in stream:
+            content = chunk.choices[0].delta.content
+            # Skip empty deltas such as the opening role-only chunk
+            if content:
+                deltas += 1
+                buffer.append(content)
+                buffered_chars += len(content)
+                now = loop.time()
+                if (
+                    last_flush is None
+                    or buffered_chars >= STREAM_FLUSH_CHARS
+                    or now - last_flush > STREAM_FLUSH_INTERVAL
+                ):
+                    yield sse_event({"content": "".join(buffer), "done": False})
+                    buffer.clear()
+                    buffered_chars = 0
+                    last_flush = now
+        
+        if buffer:
+            yield sse_event({"content": "".join(buffer), "done": False})
         
         # Send completion signal
-        yield f"data: {json.dumps({'content': '', 'done': True})}\n\n"
+        yield _DONE_EVENT
+        logger.info("stream complete deltas=%d ms=%d", deltas, (loop.time() - started) * 1000)
         
     except Exception as e:
-        print(f"Error in streaming: {e}")
-        yield f"data: {json.dumps({'error': str(e), 'done': True})}\n\n"
-
-@app.post("/api/chat")
-@limiter.limit("100/minute")  # Rate limit: 100 requests per minute per IP
-async def chat(request: Request, chat_request: ChatRequest):
-    if not client.api_key:
-        raise HTTPException(status_code=500, detail="OpenAI API key not set")
+        logger.exception("Error in streaming")
+        yield sse_event({"error": str(e), "done": True})
 
-    # Get client IP and check session limits (disabled for testing)
+async def rate_limit(request: Request):
+    """Apply the per-IP rate and session limits shared by the chat routes"""
     client_ip = get_client_ip(request)
-    # if not check_session_limits(client_ip):
+    if not await rate_limiter.hit(CHAT_RATE_LIMIT, request.url.path, client_ip):
+        raise HTTPException(status_code=429, detail=f"Rate limit exceeded: {CHAT_RATE_LIMIT}")
+
+    # Session limits (disabled for testing)
+    # if not await check_session_limits(client_ip):
     #     raise HTTPException(status_code=429, detail="Too many requests. Please try again later.")
 
-    try:
-        # Filter and validate messages
-        filtered_messages = filter_system_messages(chat_request.messages)
-        
-        if not filtered_messages:
-            raise HTTPException(status_code=400, detail="No valid messages provided")
+def chat_messages(chat_request: ChatRequest) -> list:
+    """Filter and size-check messages before the event stream starts"""
+    # Filter and validate messages
+    filtered_messages, total_chars = filter_system_messages(chat_request.messages)
+    
+    if not filtered_messages:
+        raise HTTPException(status_code=400, detail="No valid messages provided")
 
-        # Additional safety: limit total tokens
-        total_chars = sum(len(msg["content"]) for msg in filtered_messages)
-        if total_chars > 20000:
-            raise HTTPException(status_code=400, detail="Request too large")
+    # Additional safety: limit total tokens
+    if total_chars > 20000:
+        raise HTTPException(status_code=400, detail="Request too large")
 
-        # Return streaming response
-        return StreamingResponse(
-            generate_stream(filtered_messages),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "*",
-            }
-        )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error calling OpenAI: {e}")
-        raise HTTPException(status_code=500, detail="Failed to process request")
+    return filtered_messages
+
+@app.post("/api/chat", response_class=EventSourceResponse, dependencies=[Depends(rate_limit)])
+async def chat(filtered_messages: list = Depends(chat_messages)):
+    # FastAPI frames each yielded event and adds the SSE response headers
+    async for event in generate_stream(filtered_messages):
+        yield event
 
 # Add a non-streaming endpoint for fallback
-@app.post("/api/chat-simple")
-@limiter.limit("100/minute")
-async def chat_simple(request: Request, chat_request: ChatRequest):
+@app.post("/api/chat-simple", dependencies=[Depends(rate_limit)])
+async def chat_simple(chat_request: ChatRequest):
     """Non-streaming version for testing"""
-    if not client.api_key:
-        raise HTTPException(status_code=500, detail="OpenAI API key not set")
-
-    # Get client IP and check session limits (disabled for testing)
-    client_ip = get_client_ip(request)
-    # if not check_session_limits(client_ip):
-    #     raise HTTPException(status_code=429, detail="Too many requests. Please try again later.")
-
     try:
-        filtered_messages = filter_system_messages(chat_request.messages)
+        filtered_messages, total_chars = filter_system_messages(chat_request.messages)
         
         if not filtered_messages:
             raise HTTPException(status_code=400, detail="No valid messages provided")
 
-        total_chars = sum(len(msg["content"]) for msg in filtered_messages)
         if total_chars > 5000:
             raise HTTPException(status_code=400, detail="Request too large")
 
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model="gpt-4o",
             messages=filtered_messages,
             max_tokens=1000,
@@ -227,11 +454,30 @@ async def chat_simple(request: Request, chat_request: ChatRequest):
         
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error calling OpenAI: {e}")
+    except Exception:
+        logger.exception("Error calling OpenAI")
         raise HTTPException(status_code=500, detail="Failed to process request")
 
 if __name__ == "__main__":
+    import copy
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    from uvicorn.config import LOGGING_CONFIG
+
+    # uvicorn itself logs at warning level; keep this app's INFO logs (such
+    # as per-stream metrics) on uvicorn's default handler
+    log_config = copy.deepcopy(LOGGING_CONFIG)
+    log_config["loggers"]["main"] = {"handlers": ["default"], "level": "INFO"}
+
+    # Workers need an import string. Without REDIS_URL every limit is kept in
+    # process memory, so default to a single worker to keep them accurate.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "4" if REDIS_URL else "1")),
+        log_level="warning",
+        log_config=log_config,
+    )
 